@@ -1,23 +1,78 @@
 #!/usr/bin/env python3
 import argparse
 import asyncio
-import base64
-import json
+import functools
+import io
 import os
 import re
-import shutil
-import subprocess
-import tempfile
+import signal
 from pathlib import Path
-from typing import Iterable, Optional, Tuple
+from typing import Iterable, Optional, TextIO, Tuple
 
 import httpx
+import orjson
+import pybase64 as base64
 from dotenv import load_dotenv
 from openai import AsyncOpenAI
+from PIL import Image
 
 
-def _sniff_kind(path: Path) -> str:
-    head = path.read_bytes()[:16]
+_DATA_URL_RE = re.compile(r"(data:image/[a-zA-Z0-9.+-]+;base64,[A-Za-z0-9+/=]+)")
+_DATA_URL_PREFIX_RE = re.compile(r"data:image/[a-zA-Z0-9.+-]+;base64,")
+_B64_RUN_RE = re.compile(r"[A-Za-z0-9+/=]*")
+_MD_IMAGE_RE = re.compile(r"!\[[^\]]*\]\((https?://[^\s)]+)\)")
+_URL_RE = re.compile(r"(https?://\S+)")
+
+
+class _Admission:
+    """Concurrency gate like asyncio.Semaphore, but its limit can be changed mid-run."""
+
+    def __init__(self, limit: int) -> None:
+        self.active = 0
+        self.limit = max(1, limit)
+        self._cv = asyncio.Condition()
+        self._resizes: set[asyncio.Task] = set()
+
+    async def __aenter__(self) -> None:
+        async with self._cv:
+            await self._cv.wait_for(lambda: self.active < self.limit)
+            self.active += 1
+
+    async def __aexit__(self, *exc) -> None:
+        async with self._cv:
+            self.active -= 1
+            self._cv.notify(1)
+
+    async def resize(self, limit: int) -> None:
+        self.limit = max(1, limit)
+        await self._wake_all()
+
+    async def _wake_all(self) -> None:
+        async with self._cv:
+            self._cv.notify_all()
+
+    def install_signal_handlers(self) -> None:
+        """SIGUSR1 lowers the limit by one, SIGUSR2 raises it by one (Unix only)."""
+        loop = asyncio.get_running_loop()
+
+        def bump(delta: int) -> None:
+            # Signal handlers run on the loop thread, so update the limit right
+            # away (back-to-back signals must see each other); waiters only need
+            # to be woken to re-check it.
+            self.limit = max(1, self.limit + delta)
+            print(f"Concurrency -> {self.limit}")
+            task = loop.create_task(self._wake_all())
+            self._resizes.add(task)
+            task.add_done_callback(self._resizes.discard)
+
+        try:
+            loop.add_signal_handler(signal.SIGUSR1, bump, -1)
+            loop.add_signal_handler(signal.SIGUSR2, bump, 1)
+        except (AttributeError, NotImplementedError):
+            pass
+
+
+def _kind_from_head(head: bytes) -> str:
     if head.startswith(b"\xff\xd8\xff"):
         return "jpeg"
     if head.startswith(b"\x89PNG\r\n\x1a\n"):
@@ -29,45 +84,68 @@ def _sniff_kind(path: Path) -> str:
     return "unknown"
 
 
+_MIME_BY_EXT = {".png": "image/png", ".jpg": "image/jpeg", ".jpeg": "image/jpeg"}
+
+
 def _data_url_png_or_jpeg(path: Path) -> str:
-    kind = _sniff_kind(path)
-    if kind in ("png", "jpeg"):
-        mime = "image/png" if kind == "png" else "image/jpeg"
+    # Trust the common extensions; only sniff ambiguous files.
+    mime = _MIME_BY_EXT.get(path.suffix.lower())
+    if mime:
         return f"data:{mime};base64,{_read_b64(path)}"
+    with path.open("rb") as f:
+        head = f.read(16)
+        kind = _kind_from_head(head)
+        if kind in ("png", "jpeg"):
+            mime = "image/png" if kind == "png" else "image/jpeg"
+            return f"data:{mime};base64,{_b64(head + f.read())}"
     if kind == "webp":
-        sips = shutil.which("sips")
-        if not sips:
-            return f"data:image/png;base64,{_read_b64(path)}"
-        with tempfile.TemporaryDirectory() as td:
-            out = Path(td) / "converted.png"
-            subprocess.run([sips, "-s", "format", "png", str(path), "--out", str(out)], check=True, capture_output=True)
-            return f"data:image/png;base64,{_read_b64(out)}"
+        # Convert in-process; this runs in a worker thread, not the event loop.
+        buf = io.BytesIO()
+        with Image.open(path) as img:
+            img.save(buf, "PNG")
+        return f"data:image/png;base64,{_b64(buf.getvalue())}"
     return f"data:application/octet-stream;base64,{_read_b64(path)}"
 
 
+@functools.lru_cache(maxsize=8)
+def _cached_data_url(path: Path, mtime_ns: int, size: int) -> str:
+    # mtime/size are only part of the cache key, so an edited file is re-encoded.
+    return _data_url_png_or_jpeg(path)
+
+
+def _ref_data_url(path: Path) -> str:
+    st = path.stat()
+    return _cached_data_url(path, st.st_mtime_ns, st.st_size)
+
+
+def _b64(data: bytes) -> str:
+    return base64.b64encode(data).decode("utf-8")
+
+
 def _read_b64(path: Path) -> str:
-    return base64.b64encode(path.read_bytes()).decode("utf-8")
+    return _b64(path.read_bytes())
 
 
 def _iter_images(imgs_dir: Path) -> Iterable[Path]:
-    for p in sorted(imgs_dir.iterdir()):
-        if not p.is_file():
-            continue
-        if p.suffix.lower() == ".gif":
+    # DirEntry.is_file() uses the d_type from readdir, so no stat per file.
+    with os.scandir(imgs_dir) as it:
+        entries = [e for e in it if e.is_file()]
+    entries.sort(key=lambda e: e.name)
+    for e in entries:
+        if e.name.lower().endswith(".gif"):
             continue
-        yield p
+        yield imgs_dir / e.name
 
 
 def _load_done_inputs(manifest_path: Path) -> set[str]:
     done: set[str] = set()
     if not manifest_path.exists():
         return done
-    for line in manifest_path.read_text(encoding="utf-8").splitlines():
-        line = line.strip()
-        if not line:
+    for line in manifest_path.read_bytes().splitlines():
+        if not line.strip():
             continue
         try:
-            obj = json.loads(line)
+            obj = orjson.loads(line)
         except Exception:
             continue
         if obj.get("ok") is True and isinstance(obj.get("input"), str):
@@ -82,23 +160,96 @@ def _extract_image_payload(text: str) -> Tuple[Optional[str], Optional[bytes]]:
       - data:image/...;base64,...
       - raw URL in text (common for local gateway endpoints)
     """
-    m = re.search(r"(data:image/[a-zA-Z0-9.+-]+;base64,[A-Za-z0-9+/=]+)", text)
+    m = _DATA_URL_RE.search(text)
     if m:
         data_url = m.group(1)
         b64 = data_url.split(",", 1)[1]
-        return None, base64.b64decode(b64)
+        return None, base64.b64decode(b64, validate=False)
 
     # markdown image: ![image](https://...)
-    m = re.search(r"!\\[[^\\]]*\\]\\((https?://[^\\s)]+)\\)", text)
+    m = _MD_IMAGE_RE.search(text)
     if m:
         return m.group(1), None
 
-    m = re.search(r"(https?://\\S+)", text)
+    m = _URL_RE.search(text)
     if m:
         return m.group(1).rstrip(").,]\"'"), None
     return None, None
 
 
+class _StreamedImage:
+    """
+    Incrementally decodes the first data:image/...;base64 payload out of
+    streamed completion text, so the base64 text is never held in full.
+    Text before the payload is kept for the URL fallback.
+    """
+
+    def __init__(self) -> None:
+        self.text = ""
+        self.data: Optional[bytearray] = None
+        self._tail = ""
+        self._scanned = 0
+        self._done = False
+
+    def feed(self, chunk: str) -> None:
+        if self._done:
+            return
+        if self.data is None:
+            self.text += chunk
+            # Re-scan a little before the previous end in case the prefix was split.
+            m = _DATA_URL_PREFIX_RE.search(self.text, max(0, self._scanned - 64))
+            while m:
+                rest = self.text[m.end():]
+                if not rest:
+                    # Can't tell yet whether base64 follows; re-check this prefix next time.
+                    self._scanned = m.start()
+                    return
+                if _B64_RUN_RE.match(rest).group(0):
+                    break
+                # Prefix without any base64 (same rule as _DATA_URL_RE): not a payload.
+                m = _DATA_URL_PREFIX_RE.search(self.text, m.end())
+            else:
+                self._scanned = len(self.text)
+                return
+            chunk = rest
+            self.text = self.text[: m.start()]
+            self.data = bytearray()
+        run = _B64_RUN_RE.match(chunk).group(0)
+        self._tail += run
+        if len(run) < len(chunk):
+            self._done = True
+            self._flush(final=True)
+        else:
+            self._flush(final=False)
+
+    def finish(self) -> Optional[bytearray]:
+        if self.data is None:
+            return None
+        if not self._done:
+            self._done = True
+            self._flush(final=True)
+        # Hand back the bytearray itself; copying it would double peak memory.
+        return self.data or None
+
+    def _flush(self, final: bool) -> None:
+        n = len(self._tail) if final else len(self._tail) // 4 * 4
+        if n:
+            self.data += base64.b64decode(self._tail[:n], validate=False)
+            self._tail = self._tail[n:]
+
+
+async def _stream_image_payload(stream) -> Tuple[Optional[str], Optional[bytes]]:
+    sink = _StreamedImage()
+    async with stream:
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                sink.feed(chunk.choices[0].delta.content)
+    data = sink.finish()
+    if data is not None:
+        return None, data
+    return _extract_image_payload(sink.text)
+
+
 def _default_ref() -> str:
     return "monkey-ip-compress.png" if Path("monkey-ip-compress.png").exists() else "monkey-ip.png"
 
@@ -162,9 +313,10 @@ async def main() -> int:
     parser.add_argument("--concurrency", type=int, default=3, help="Concurrent generations (default: 3)")
     parser.add_argument("--timeout", type=int, default=900, help="Per-request timeout seconds (default: 900)")
     parser.add_argument("--retries", type=int, default=2, help="Retries per image on failure (default: 2)")
-    parser.add_argument("--retry-delay", type=float, default=3.0, help="Seconds between retries (default: 3.0)")
+    parser.add_argument("--retry-delay", type=float, default=3.0, help="Base seconds between retries, doubled each attempt (default: 3.0)")
     parser.add_argument("--limit", type=int, default=0, help="Only process first N images (default: 0 = all)")
     parser.add_argument("--no-resume", action="store_true", help="Do not skip already-processed inputs")
+    parser.add_argument("--no-stream", action="store_true", help="Wait for the full response instead of streaming it")
     args = parser.parse_args()
 
     load_dotenv(dotenv_path=Path(".env"))
@@ -200,77 +352,105 @@ async def main() -> int:
     client = AsyncOpenAI(base_url=base_url, api_key=api_key, timeout=args.timeout)
     prompt = _build_prompt()
 
-    ref_data_url = _data_url_png_or_jpeg(ref_path)
+    ref_data_url = _ref_data_url(ref_path)
+    # Parts shared by every request; only the input image changes per call.
+    prompt_part = {"type": "text", "text": prompt}
+    ref_part = {"type": "image_url", "image_url": {"url": ref_data_url}}
 
-    sem = asyncio.Semaphore(max(1, args.concurrency))
+    sem = _Admission(args.concurrency)
+    sem.install_signal_handlers()
     lock = asyncio.Lock()
     progress = {"done": 0, "total": len(inputs)}
 
-    async with httpx.AsyncClient(timeout=args.timeout) as http:
+    # Keep one append handle per file for the whole run. The manifest is the
+    # resume state, so every record is flushed to the OS as soon as it is
+    # written. failed.txt is only created once something actually fails.
+    manifest_fp = manifest_path.open("ab")
+    failed_fp: Optional[TextIO] = None
+
+    # Size the pool to the concurrency so keep-alive connections are reused
+    # instead of churned when the model answers with image URLs.
+    pool = max(1, args.concurrency) * 2
+    limits = httpx.Limits(max_connections=pool, max_keepalive_connections=pool)
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limits, http2=True) as http:
 
         async def process_one(in_path: Path) -> None:
+            nonlocal failed_fp
             async with sem:
                 out_name = _out_name(in_path)
                 out_path = out_dir / out_name
-                in_data_url = _data_url_png_or_jpeg(in_path)
-
                 rec = {"input": str(in_path), "output": str(out_path), "ok": False, "model": args.model}
                 try:
+                    # Inside the try: a bad input becomes a failed record, not a crashed run.
+                    in_data_url = await asyncio.to_thread(_data_url_png_or_jpeg, in_path)
+
+                    messages = [
+                        {
+                            "role": "user",
+                            "content": [
+                                prompt_part,
+                                {"type": "image_url", "image_url": {"url": in_data_url}},  # 图1
+                                ref_part,  # 图2
+                            ],
+                        }
+                    ]
+
                     for attempt in range(args.retries + 1):
                         try:
-                            resp = await client.chat.completions.create(
-                                model=args.model,
-                                temperature=0,
-                                messages=[
-                                    {
-                                        "role": "user",
-                                        "content": [
-                                            {"type": "text", "text": prompt},
-                                            {"type": "image_url", "image_url": {"url": in_data_url}},  # 图1
-                                            {"type": "image_url", "image_url": {"url": ref_data_url}},  # 图2
-                                        ],
-                                    }
-                                ],
-                            )
-                            content = resp.choices[0].message.content
-                            if isinstance(content, list):
-                                content = "\n".join(str(x) for x in content)
-                            if not isinstance(content, str):
-                                content = str(content)
-
-                            url, data = _extract_image_payload(content)
+                            if args.no_stream:
+                                resp = await client.chat.completions.create(
+                                    model=args.model, temperature=0, messages=messages
+                                )
+                                content = resp.choices[0].message.content
+                                if isinstance(content, list):
+                                    content = "\n".join(str(x) for x in content)
+                                if not isinstance(content, str):
+                                    content = str(content)
+                                url, data = _extract_image_payload(content)
+                            else:
+                                stream = await client.chat.completions.create(
+                                    model=args.model, temperature=0, messages=messages, stream=True
+                                )
+                                url, data = await _stream_image_payload(stream)
                             if data is not None:
-                                out_path.write_bytes(data)
+                                await asyncio.to_thread(out_path.write_bytes, data)
                                 rec["ok"] = True
                                 break
                             if url:
                                 r = await http.get(url)
                                 r.raise_for_status()
-                                out_path.write_bytes(r.content)
+                                await asyncio.to_thread(out_path.write_bytes, r.content)
                                 rec["ok"] = True
                                 rec["url"] = url
                                 break
                             raise RuntimeError("Model response didn't include image URL/base64")
                         except Exception as e:
                             if attempt < args.retries:
-                                await asyncio.sleep(args.retry-delay)
+                                await asyncio.sleep(args.retry_delay * (2 ** attempt))
                                 continue
                             raise
                 except Exception as e:
                     rec["error"] = str(e)
                     async with lock:
-                        with failed_path.open("a", encoding="utf-8") as f:
-                            f.write(f"{in_path}\t{e}\n")
+                        if failed_fp is None:
+                            failed_fp = failed_path.open("a", encoding="utf-8")
+                        failed_fp.write(f"{in_path}\t{e}\n")
+                        failed_fp.flush()
                 finally:
                     async with lock:
-                        with manifest_path.open("a", encoding="utf-8") as f:
-                            f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+                        manifest_fp.write(orjson.dumps(rec) + b"\n")
+                        manifest_fp.flush()
                         progress["done"] += 1
                         if progress["done"] % 10 == 0 or progress["done"] == progress["total"]:
                             ok = "ok" if rec.get("ok") else "fail"
                             print(f"[{progress['done']}/{progress['total']}] {ok}: {in_path.name}")
 
-        await asyncio.gather(*(process_one(p) for p in inputs))
+        try:
+            await asyncio.gather(*(process_one(p) for p in inputs))
+        finally:
+            manifest_fp.close()
+            if failed_fp is not None:
+                failed_fp.close()
 
     print("Done.")
     print(f"Manifest: {manifest_path}")
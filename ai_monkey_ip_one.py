@@ -1,6 +1,5 @@
 #!/usr/bin/env python3
 import argparse
-import base64
 import os
 import re
 import shutil
@@ -9,16 +8,23 @@ import tempfile
 from pathlib import Path
 from typing import Optional, Tuple
 
+import pybase64 as base64
 import requests
 from dotenv import load_dotenv
 from openai import OpenAI
 
 
+_DATA_URL_RE = re.compile(r"(data:image/[a-zA-Z0-9.+-]+;base64,[A-Za-z0-9+/=]+)")
+_URL_RE = re.compile(r"(https?://\S+)")
+
+
 def _read_b64(path: Path) -> str:
     return base64.b64encode(path.read_bytes()).decode("utf-8")
 
 def _sniff_kind(path: Path) -> str:
-    head = path.read_bytes()[:16]
+    # Unbuffered: a single 16-byte read() without filling a read-ahead buffer.
+    with path.open("rb", buffering=0) as f:
+        head = f.read(16)
     if head.startswith(b"\xff\xd8\xff"):
         return "jpeg"
     if head.startswith(b"\x89PNG\r\n\x1a\n"):
@@ -61,13 +67,13 @@ def _extract_image_payload(text: str) -> Tuple[Optional[str], Optional[bytes]]:
       - data:image/...;base64,...
       - raw URL in text
     """
-    m = re.search(r"(data:image/[a-zA-Z0-9.+-]+;base64,[A-Za-z0-9+/=]+)", text)
+    m = _DATA_URL_RE.search(text)
     if m:
         data_url = m.group(1)
         b64 = data_url.split(",", 1)[1]
-        return None, base64.b64decode(b64)
+        return None, base64.b64decode(b64, validate=False)
 
-    m = re.search(r"(https?://\\S+)", text)
+    m = _URL_RE.search(text)
     if m:
         return m.group(1).rstrip(").,]\"'"), None
     return None, None
@@ -162,8 +168,9 @@ def main() -> int:
     if data is not None:
         out_path.write_bytes(data)
     elif url:
-        r = requests.get(url, timeout=120)
-        r.raise_for_status()
+        with requests.Session() as session:
+            r = session.get(url, timeout=120)
+            r.raise_for_status()
         out_path.write_bytes(r.content)
     else:
         raise SystemExit(f"Model response didn't include an image URL/base64. Raw content:\n{content}")
@@ -2,10 +2,19 @@ import os
 import shutil
 from pathlib import Path
 from PIL import Image
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 import time
 
+try:
+    # libvips streams decode -> encode instead of materialising the whole
+    # image like Pillow does; fall back to Pillow when it isn't installed.
+    import pyvips
+except (ImportError, OSError):
+    pyvips = None
+
 def compress_image(file_path, output_dir):
+    """Returns (status, source_bytes, target_bytes), or None for non-image files."""
     try:
         if file_path.suffix.lower() not in ['.png', '.jpg', '.jpeg']:
             return None
@@ -17,14 +26,19 @@ def compress_image(file_path, output_dir):
         # if output_path.exists():
         #     return f"Skipped {output_filename}"
 
-        with Image.open(file_path) as img:
-            # Convert to RGB if RGBA and saving as JPEG, but WebP supports RGBA.
-            # However, for consistency and size, we stick to default WebP settings.
-            img.save(output_path, "WEBP", quality=80, method=6)
+        if pyvips is not None:
+            img = pyvips.Image.new_from_file(str(file_path), access="sequential")
+            img.webpsave(str(output_path), Q=80, effort=6)
+        else:
+            with Image.open(file_path) as img:
+                # Convert to RGB if RGBA and saving as JPEG, but WebP supports RGBA.
+                # However, for consistency and size, we stick to default WebP settings.
+                img.save(output_path, "WEBP", quality=80, method=6)
             
-        return f"Compressed: {file_path.name} -> {output_filename}"
+        status = f"Compressed: {file_path.name} -> {output_filename}"
+        return status, file_path.stat().st_size, output_path.stat().st_size
     except Exception as e:
-        return f"Error compressing {file_path.name}: {e}"
+        return f"Error compressing {file_path.name}: {e}", 0, 0
 
 def process_directory(source_dir_name, target_dir_path):
     source_dir = Path(source_dir_name)
@@ -47,15 +61,20 @@ def process_directory(source_dir_name, target_dir_path):
     print(f"Starting compression for {source_dir} -> {target_dir}...")
     start_time = time.time()
     
-    files = list(source_dir.glob("*"))
+    # DirEntry.is_file() uses the d_type from readdir, so no stat per file.
+    with os.scandir(source_dir) as it:
+        entries = [e for e in it if e.is_file()]
+    files = [source_dir / e.name for e in entries]
     max_workers = os.cpu_count() or 4
     
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        results = list(executor.map(lambda f: compress_image(f, target_dir), files))
+    # WebP encoding is CPU-bound, so use processes rather than GIL-bound threads.
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(compress_image, files, repeat(target_dir), chunksize=8))
         
     # Print summary
-    success_count = sum(1 for r in results if r and r.startswith("Compressed"))
-    error_count = sum(1 for r in results if r and r.startswith("Error"))
+    results = [r for r in results if r]
+    success_count = sum(1 for status, _, _ in results if status.startswith("Compressed"))
+    error_count = sum(1 for status, _, _ in results if status.startswith("Error"))
     
     end_time = time.time()
     duration = end_time - start_time
@@ -64,9 +83,9 @@ def process_directory(source_dir_name, target_dir_path):
     print(f"Successfully compressed: {success_count} images")
     print(f"Errors: {error_count}")
     
-    # Calculate size diff
-    source_size = sum(f.stat().st_size for f in source_dir.glob("*") if f.is_file()) / (1024*1024)
-    target_size = sum(f.stat().st_size for f in target_dir.glob("*") if f.is_file()) / (1024*1024)
+    # Calculate size diff (of the images compressed in this run)
+    source_size = sum(src for _, src, _ in results) / (1024*1024)
+    target_size = sum(dst for _, _, dst in results) / (1024*1024)
     
     print(f"Original Size: {source_size:.2f} MB")
     print(f"Compressed Size: {target_size:.2f} MB")
@@ -2,17 +2,73 @@
 import argparse
 import asyncio
 import hashlib
-import json
 import mimetypes
 import re
+import signal
 from pathlib import Path
-from typing import Tuple
+from typing import Optional, TextIO, Tuple
 from urllib.parse import urljoin, urlparse, urlunparse
 
+import httpx
+import orjson
 from playwright.async_api import async_playwright
 
 
 DEFAULT_URL = "https://www.pighub.top/all"
+# All images come from one CDN host; going past this tends to get throttled.
+MAX_HOST_CONNECTIONS = 16
+
+_MANIFEST_URL_RE = re.compile(rb'"url":\s*"([^"]*)"')
+_IMG_EXT_RE = re.compile(r"\.(?:jpe?g|png|webp|gif|bmp|svg|avif|heic)$", re.IGNORECASE)
+_SAFE_STEM_RE = re.compile(r"[^\w.-]+", flags=re.UNICODE)
+
+
+class _Admission:
+    """Concurrency gate like asyncio.Semaphore, but its limit can be changed mid-run."""
+
+    def __init__(self, limit: int) -> None:
+        self.active = 0
+        self.limit = max(1, limit)
+        self._cv = asyncio.Condition()
+        self._resizes: set[asyncio.Task] = set()
+
+    async def __aenter__(self) -> None:
+        async with self._cv:
+            await self._cv.wait_for(lambda: self.active < self.limit)
+            self.active += 1
+
+    async def __aexit__(self, *exc) -> None:
+        async with self._cv:
+            self.active -= 1
+            self._cv.notify(1)
+
+    async def resize(self, limit: int) -> None:
+        self.limit = max(1, limit)
+        await self._wake_all()
+
+    async def _wake_all(self) -> None:
+        async with self._cv:
+            self._cv.notify_all()
+
+    def install_signal_handlers(self) -> None:
+        """SIGUSR1 lowers the limit by one, SIGUSR2 raises it by one (Unix only)."""
+        loop = asyncio.get_running_loop()
+
+        def bump(delta: int) -> None:
+            # Signal handlers run on the loop thread, so update the limit right
+            # away (back-to-back signals must see each other); waiters only need
+            # to be woken to re-check it.
+            self.limit = max(1, self.limit + delta)
+            print(f"Concurrency -> {self.limit}")
+            task = loop.create_task(self._wake_all())
+            self._resizes.add(task)
+            task.add_done_callback(self._resizes.discard)
+
+        try:
+            loop.add_signal_handler(signal.SIGUSR1, bump, -1)
+            loop.add_signal_handler(signal.SIGUSR2, bump, 1)
+        except (AttributeError, NotImplementedError):
+            pass
 
 
 def _clean_url(url: str) -> str:
@@ -27,25 +83,11 @@ def _clean_url(url: str) -> str:
 
 
 def _is_probably_image_url(url: str) -> bool:
-    path = urlparse(url).path.lower()
-    return any(
-        path.endswith(ext)
-        for ext in (
-            ".jpg",
-            ".jpeg",
-            ".png",
-            ".webp",
-            ".gif",
-            ".bmp",
-            ".svg",
-            ".avif",
-            ".heic",
-        )
-    )
+    return _IMG_EXT_RE.search(urlparse(url).path) is not None
 
 
 def _safe_stem(text: str, max_len: int = 80) -> str:
-    text = re.sub(r"[^\w.-]+", "_", text, flags=re.UNICODE).strip("._")
+    text = _SAFE_STEM_RE.sub("_", text).strip("._")
     if not text:
         text = "image"
     return text[:max_len]
@@ -74,45 +116,83 @@ def _guess_ext(url: str, content_type: str) -> str:
     return guessed or ".img"
 
 
-async def _extract_image_urls(page, base_url: str) -> list[str]:
-    raw_urls: list[str] = await page.evaluate(
-        """
-      () => {
-        function pickFromSrcset(srcset) {
-          // Pick the last candidate (usually highest resolution).
-          const parts = (srcset || "").split(",").map(s => s.trim()).filter(Boolean);
-          if (!parts.length) return "";
-          const last = parts[parts.length - 1];
-          return last.split(/\\s+/)[0] || "";
-        }
-
-        const out = new Set();
-        const imgAttrs = ["src", "data-src", "data-lazy-src", "data-original", "data-url", "data-img"];
-
-        for (const img of document.querySelectorAll("img")) {
-          for (const a of imgAttrs) {
-            const v = img.getAttribute(a);
-            if (v) out.add(v);
-          }
-          const ss = img.getAttribute("srcset");
-          if (ss) out.add(pickFromSrcset(ss));
-        }
-
-        for (const source of document.querySelectorAll("source")) {
-          const ss = source.getAttribute("srcset");
-          if (ss) out.add(pickFromSrcset(ss));
-        }
-
-        for (const el of document.querySelectorAll('[style*="background-image"]')) {
-          const bg = el.style && el.style.backgroundImage ? el.style.backgroundImage : "";
-          const m = /url\\((['"]?)(.*?)\\1\\)/.exec(bg);
-          if (m && m[2]) out.add(m[2]);
-        }
-
-        return Array.from(out).filter(Boolean);
+# Installed as an init script so the observer sees every node from the first
+# parse. Each round drains only the URLs that appeared since the previous one,
+# instead of re-walking the whole (ever-growing) DOM.
+_IMAGE_URL_OBSERVER_JS = """
+(() => {
+  const imgAttrs = ["src", "data-src", "data-lazy-src", "data-original", "data-url", "data-img"];
+
+  function pickFromSrcset(srcset) {
+    // Pick the last candidate (usually highest resolution).
+    const parts = (srcset || "").split(",").map(s => s.trim()).filter(Boolean);
+    if (!parts.length) return "";
+    const last = parts[parts.length - 1];
+    return last.split(/\\s+/)[0] || "";
+  }
+
+  function collect(el, out) {
+    if (!el || el.nodeType !== 1) return;
+    if (el.tagName === "IMG") {
+      for (const a of imgAttrs) {
+        const v = el.getAttribute(a);
+        if (v) out.push(v);
       }
+    }
+    if (el.tagName === "IMG" || el.tagName === "SOURCE") {
+      const ss = el.getAttribute("srcset");
+      if (ss) out.push(pickFromSrcset(ss));
+    }
+    const bg = el.style && el.style.backgroundImage ? el.style.backgroundImage : "";
+    if (bg) {
+      const m = /url\\((['"]?)(.*?)\\1\\)/.exec(bg);
+      if (m && m[2]) out.push(m[2]);
+    }
+  }
+
+  function collectTree(root, out) {
+    collect(root, out);
+    if (!root || !root.querySelectorAll) return;
+    for (const el of root.querySelectorAll('img, source, [style*="background-image"]')) collect(el, out);
+  }
+
+  window.__newUrls = [];
+  new MutationObserver((records) => {
+    for (const r of records) {
+      if (r.type === "attributes") collect(r.target, window.__newUrls);
+      else for (const n of r.addedNodes) collectTree(n, window.__newUrls);
+    }
+  }).observe(document, {
+    subtree: true,
+    childList: true,
+    attributes: true,
+    attributeFilter: [...imgAttrs, "srcset", "style"],
+  });
+
+  window.__scanImageUrls = () => {
+    const out = [];
+    collectTree(document.documentElement, out);
+    window.__newUrls = [];
+    return Array.from(new Set(out)).filter(Boolean);
+  };
+  window.__drainImageUrls = () => {
+    const r = window.__newUrls;
+    window.__newUrls = [];
+    return Array.from(new Set(r)).filter(Boolean);
+  };
+})();
+"""
+
+
+async def _extract_image_urls(page, base_url: str, full_scan: bool = False) -> list[str]:
     """
-    )
+    Returns image URLs seen since the previous call (requires _IMAGE_URL_OBSERVER_JS
+    to be installed on the page); full_scan walks the whole DOM instead.
+    """
+    if full_scan:
+        raw_urls: list[str] = await page.evaluate("() => window.__scanImageUrls()")
+    else:
+        raw_urls = await page.evaluate("() => window.__drainImageUrls()")
 
     cleaned: list[str] = []
     for u in raw_urls:
@@ -159,8 +239,8 @@ async def _auto_load_all(page, base_url: str, max_rounds: int, settle_rounds: in
     seen: set[str] = set()
     stable = 0
 
-    for _ in range(max_rounds):
-        urls = await _extract_image_urls(page, base_url)
+    for i in range(max_rounds):
+        urls = await _extract_image_urls(page, base_url, full_scan=i == 0)
         before = len(seen)
         seen.update(urls)
         after = len(seen)
@@ -180,22 +260,32 @@ async def _auto_load_all(page, base_url: str, max_rounds: int, settle_rounds: in
     return sorted(seen)
 
 
-def _load_existing_manifest(manifest_path: Path) -> set[str]:
-    urls: set[str] = set()
+def _url_key(url: str) -> bytes:
+    return hashlib.blake2b(url.encode("utf-8"), digest_size=8).digest()
+
+
+def _load_existing_manifest(manifest_path: Path) -> set[bytes]:
+    """Returns _url_key() digests of the URLs already recorded in the manifest."""
+    keys: set[bytes] = set()
     if not manifest_path.exists():
-        return urls
-    for line in manifest_path.read_text(encoding="utf-8").splitlines():
-        line = line.strip()
-        if not line:
-            continue
-        try:
-            obj = json.loads(line)
-            u = obj.get("url")
+        return keys
+    with manifest_path.open("rb") as f:
+        for line in f:
+            m = _MANIFEST_URL_RE.search(line)
+            if not m or not m.group(1):
+                continue
+            raw = m.group(1)
+            if b"\\" not in raw:
+                keys.add(hashlib.blake2b(raw, digest_size=8).digest())
+                continue
+            # Escaped characters: let the JSON parser unescape them.
+            try:
+                u = orjson.loads(line).get("url")
+            except Exception:
+                continue
             if isinstance(u, str) and u:
-                urls.add(u)
-        except Exception:
-            continue
-    return urls
+                keys.add(_url_key(u))
+    return keys
 
 
 async def main() -> int:
@@ -206,7 +296,7 @@ async def main() -> int:
     parser.add_argument("--max-rounds", type=int, default=300, help="Max load-more/scroll rounds (default: 300)")
     parser.add_argument("--settle-rounds", type=int, default=6, help="Stop after N stable rounds (default: 6)")
     parser.add_argument("--pause-ms", type=int, default=1200, help="Pause between rounds in ms (default: 1200)")
-    parser.add_argument("--concurrency", type=int, default=8, help="Concurrent downloads (default: 8)")
+    parser.add_argument("--concurrency", type=int, default=8, help=f"Concurrent downloads, capped at {MAX_HOST_CONNECTIONS} (default: 8)")
     args = parser.parse_args()
 
     out_dir = Path(args.out)
@@ -219,6 +309,7 @@ async def main() -> int:
         browser = await p.chromium.launch(headless=not args.headful)
         context = await browser.new_context()
         page = await context.new_page()
+        await page.add_init_script(_IMAGE_URL_OBSERVER_JS)
 
         await page.goto(args.url, wait_until="domcontentloaded")
         try:
@@ -229,39 +320,71 @@ async def main() -> int:
         urls = await _auto_load_all(
             page, base_url=args.url, max_rounds=args.max_rounds, settle_rounds=args.settle_rounds, pause_ms=args.pause_ms
         )
-        urls = [u for u in urls if u not in existing_urls]
+        urls = [u for u in urls if _url_key(u) not in existing_urls]
 
         print(f"Found {len(urls) + len(existing_urls)} image URLs total; downloading {len(urls)} new...")
 
-        sem = asyncio.Semaphore(max(1, args.concurrency))
+        sem = _Admission(min(args.concurrency, MAX_HOST_CONNECTIONS))
+        sem.install_signal_handlers()
         lock = asyncio.Lock()
 
+        # One append handle per file for the whole run. The manifest is the
+        # resume state, so every record is flushed to the OS as soon as it is
+        # written. failed.txt is only created once something actually fails.
+        manifest_fp = manifest_path.open("ab")
+        failed_fp: Optional[TextIO] = None
+
         async def download_one(idx: int, url: str) -> None:
+            nonlocal failed_fp
             async with sem:
                 url_hash = hashlib.sha1(url.encode("utf-8")).hexdigest()[:12]
                 basename = Path(urlparse(url).path).name or "image"
                 stem = _safe_stem(Path(basename).stem)
 
                 try:
-                    resp = await context.request.get(url, timeout=60000)
-                    if not resp.ok:
-                        raise RuntimeError(f"HTTP {resp.status}")
-                    body = await resp.body()
-                    ext = _guess_ext(url, resp.headers.get("content-type", ""))
-
-                    filename = f"{idx:06d}_{stem}_{url_hash}{ext}"
-                    filepath = out_dir / filename
-                    filepath.write_bytes(body)
+                    # Stream to disk so each task holds at most one chunk in memory.
+                    async with http.stream("GET", url) as resp:
+                        if not resp.is_success:
+                            raise RuntimeError(f"HTTP {resp.status_code}")
+                        ext = _guess_ext(url, resp.headers.get("content-type", ""))
+
+                        filename = f"{idx:06d}_{stem}_{url_hash}{ext}"
+                        filepath = out_dir / filename
+                        try:
+                            with filepath.open("wb") as f:
+                                async for chunk in resp.aiter_bytes(65536):
+                                    f.write(chunk)
+                        except BaseException:
+                            filepath.unlink(missing_ok=True)
+                            raise
 
                     async with lock:
-                        with manifest_path.open("a", encoding="utf-8") as f:
-                            f.write(json.dumps({"url": url, "file": filename}, ensure_ascii=False) + "\n")
+                        manifest_fp.write(orjson.dumps({"url": url, "file": filename}) + b"\n")
+                        manifest_fp.flush()
                 except Exception as e:
                     async with lock:
-                        with failed_path.open("a", encoding="utf-8") as f:
-                            f.write(f"{url}\t{e}\n")
-
-        await asyncio.gather(*(download_one(i + 1, u) for i, u in enumerate(urls)))
+                        if failed_fp is None:
+                            failed_fp = failed_path.open("a", encoding="utf-8")
+                        failed_fp.write(f"{url}\t{e}\n")
+                        failed_fp.flush()
+
+        # Reuse the browser session's identity so the CDN sees the same client.
+        headers = {"User-Agent": await page.evaluate("navigator.userAgent"), "Referer": args.url}
+        # Keep each cookie's domain/path so httpx only sends it where the browser would.
+        cookies = httpx.Cookies()
+        for c in await context.cookies():
+            cookies.set(c["name"], c["value"], domain=c["domain"], path=c["path"])
+        limits = httpx.Limits(max_connections=MAX_HOST_CONNECTIONS, max_keepalive_connections=MAX_HOST_CONNECTIONS)
+        http = httpx.AsyncClient(
+            timeout=60, follow_redirects=True, headers=headers, cookies=cookies, limits=limits, http2=True
+        )
+        try:
+            await asyncio.gather(*(download_one(i + 1, u) for i, u in enumerate(urls)))
+        finally:
+            await http.aclose()
+            manifest_fp.close()
+            if failed_fp is not None:
+                failed_fp.close()
 
         await context.close()
         await browser.close()
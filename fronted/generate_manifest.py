@@ -1,48 +1,82 @@
-import json
+import argparse
+import orjson
+import os
 from pathlib import Path
 
 # Configuration
 MANIFEST_PATH = Path("../imgs_monkey/manifest.jsonl")
 OUTPUT_FILE = Path("public/monkey_manifest.json")
+# Records which manifest.jsonl (mtime/size) OUTPUT_FILE was built from, and
+# OUTPUT_FILE's own mtime/size so outside edits to it force a rebuild.
+# Kept outside public/ so it is not deployed.
+STAMP_FILE = Path(".monkey_manifest.stamp")
 
-def generate_manifest():
+def _name_and_stem(path: str):
+    """(Path(path).name, Path(path).stem) without building Path objects."""
+    name = path.rsplit("/", 1)[-1]
+    dot = name.rfind(".")
+    stem = name[:dot] if 0 < dot < len(name) - 1 else name
+    return name, stem
+
+def _make_record(line):
+    """Returns the monkey_manifest.json entry for one JSONL line, or None to skip it."""
+    # orjson accepts the raw line bytes (trailing newline included), so
+    # no per-line decode/strip is needed.
+    if line in (b"\n", b"\r\n", b""):
+        return None
+    try:
+        record = orjson.loads(line)
+    except orjson.JSONDecodeError:
+        return None
+    if not record.get("ok"):
+        return None
+
+    # input: "imgs/filename.jpg"
+    # output: "imgs_monkey/filename__jpg.png"
+    input_name, input_stem = _name_and_stem(record["input"])
+    # Force replacement of 猪 -> 猴 in the output filename stem
+    # This handles both legacy records and new records
+    output_stem = _name_and_stem(record["output"])[1].replace("猪", "猴")
+
+    return {
+        "id": output_stem,
+        "pig_url": f"/imgs/{input_stem}.webp",
+        "monkey_url": f"/imgs_monkey/{output_stem}.webp",
+        "original_name": input_name
+    }
+
+def _with_output_stat(stamp):
+    out_stat = OUTPUT_FILE.stat()
+    return f"{stamp}:{out_stat.st_mtime_ns}:{out_stat.st_size}"
+
+def generate_manifest(pretty=False, force=False):
     if not MANIFEST_PATH.exists():
         print(f"Error: Manifest file {MANIFEST_PATH} does not exist.")
         return
 
-    images = []
-    
-    with open(MANIFEST_PATH, "r", encoding="utf-8") as f:
-        for line in f:
-            line = line.strip()
-            if not line:
-                continue
-            try:
-                record = json.loads(line)
-                if record.get("ok"):
-                    # input: "imgs/filename.jpg"
-                    # output: "imgs_monkey/filename__jpg.png"
-                    
-                    input_path = Path(record["input"])
-                    # Force replacement of 猪 -> 猴 in the output filename stem
-                    # This handles both legacy records and new records
-                    output_stem = Path(record["output"]).stem.replace("猪", "猴")
-                    
-                    images.append({
-                        "id": output_stem,
-                        "pig_url": f"/imgs/{input_path.stem}.webp",
-                        "monkey_url": f"/imgs_monkey/{output_stem}.webp",
-                        "original_name": input_path.name
-                    })
-            except json.JSONDecodeError:
-                continue
-
-    # Write to JSON
-    with open(OUTPUT_FILE, "w", encoding="utf-8") as f:
-        json.dump(images, f, ensure_ascii=False, indent=2)
+    src_stat = MANIFEST_PATH.stat()
+    stamp = f"{src_stat.st_mtime_ns}:{src_stat.st_size}:{int(pretty)}"
+    if not force and OUTPUT_FILE.exists() and STAMP_FILE.exists() and STAMP_FILE.read_text() == _with_output_stat(stamp):
+        print(f"{OUTPUT_FILE} is up to date; nothing to do (use --force to rebuild).")
+        return
+
+    with open(MANIFEST_PATH, "rb") as f:
+        images = [image for image in map(_make_record, f) if image is not None]
+
+    # Write to JSON (compact by default; the frontend never needs indentation)
+    option = orjson.OPT_INDENT_2 if pretty else 0
+    OUTPUT_FILE.write_bytes(orjson.dumps(images, option=option))
+
+    tmp_stamp = STAMP_FILE.with_name(STAMP_FILE.name + ".tmp")
+    tmp_stamp.write_text(_with_output_stat(stamp))
+    os.replace(tmp_stamp, STAMP_FILE)
 
     print(f"Manifest generated: {len(images)} pairs found.")
     print(f"Saved to {OUTPUT_FILE}")
 
 if __name__ == "__main__":
-    generate_manifest()
+    parser = argparse.ArgumentParser(description="Build public/monkey_manifest.json from ../imgs_monkey/manifest.jsonl.")
+    parser.add_argument("--pretty", action="store_true", help="Indent the JSON output (for debugging)")
+    parser.add_argument("--force", action="store_true", help="Rebuild even if the source manifest is unchanged")
+    args = parser.parse_args()
+    generate_manifest(pretty=args.pretty, force=args.force)
@@ -2,13 +2,18 @@ import json
 from pathlib import Path
 from datetime import datetime
 from urllib.parse import quote
-import xml.etree.ElementTree as ET
-from xml.dom import minidom
+from xml.sax.saxutils import escape
 
 # Configuration
 MANIFEST_PATH = Path("public/monkey_manifest.json")
 OUTPUT_FILE = Path("public/sitemap.xml")
 BASE_URL = "https://monkeyhub.icu"
+SITEMAP_NS = "http://www.sitemaps.org/schemas/sitemap/0.9"
+IMAGE_NS = "http://www.google.com/schemas/sitemap-image/1.1"
+
+# Characters quote(..., safe='') never escapes.
+_URL_SAFE_CHARS = frozenset("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789_.-~")
+_URL_SAFE_PATH_CHARS = _URL_SAFE_CHARS | {"/"}
 
 
 def encode_url_path(path: str) -> str:
@@ -19,18 +24,19 @@ def encode_url_path(path: str) -> str:
     Example: /imgs_monkey/000032_为猴着迷.webp 
           -> /imgs_monkey/000032_%E4%B8%BA%E7%8C%B4%E7%9D%80%E8%BF%B7.webp
     """
-    # Split path into segments, encode each segment, then rejoin
+    # Nothing to encode: skip the split/quote/join entirely.
+    if _URL_SAFE_PATH_CHARS.issuperset(path):
+        return path
+
+    # Split path into segments, encode each segment, then rejoin.
+    # Segments that are already URL-safe are passed through as-is.
     segments = path.split('/')
-    encoded_segments = [quote(segment, safe='') for segment in segments]
+    encoded_segments = [
+        segment if _URL_SAFE_CHARS.issuperset(segment) else quote(segment, safe='')
+        for segment in segments
+    ]
     return '/'.join(encoded_segments)
 
-def prettify(elem):
-    """Return a pretty-printed XML string for the Element."""
-    rough_string = ET.tostring(elem, 'utf-8')
-    reparsed = minidom.parseString(rough_string)
-    # Ensure encoding is specified in the declaration
-    return reparsed.toprettyxml(indent="  ", encoding="UTF-8").decode("utf-8")
-
 def generate_sitemap():
     if not MANIFEST_PATH.exists():
         print(f"Error: Manifest file {MANIFEST_PATH} does not exist.")
@@ -43,58 +49,54 @@ def generate_sitemap():
         print(f"Error reading manifest: {e}")
         return
 
-    # XML Namespaces
-    urlset = ET.Element('urlset')
-    urlset.set("xmlns", "http://www.sitemaps.org/schemas/sitemap/0.9")
-    urlset.set("xmlns:image", "http://www.google.com/schemas/sitemap-image/1.1")
-
-    # Single URL entry for the main page
-    url_element = ET.SubElement(urlset, "url")
-    
-    # Location
-    loc = ET.SubElement(url_element, "loc")
-    loc.text = f"{BASE_URL}/"
-    
-    # Last Modified (now)
-    lastmod = ET.SubElement(url_element, "lastmod")
-    lastmod.text = datetime.now().strftime("%Y-%m-%d")
-
-    # Change Frequency
-    changefreq = ET.SubElement(url_element, "changefreq")
-    changefreq.text = "daily"
-
-    # Priority
-    priority = ET.SubElement(url_element, "priority")
-    priority.text = "1.0"
+    # Every entry follows the same fixed layout, so write the XML from a
+    # template instead of building (and then serializing) an element tree.
+    today = datetime.now().strftime("%Y-%m-%d")
+    out = [
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        f'<urlset xmlns="{SITEMAP_NS}" xmlns:image="{IMAGE_NS}">\n'
+        "  <url>\n"
+        f"    <loc>{escape(BASE_URL)}/</loc>\n"
+        f"    <lastmod>{today}</lastmod>\n"
+        "    <changefreq>daily</changefreq>\n"
+        "    <priority>1.0</priority>\n"
+    ]
 
     print(f"Found {len(images)} images to index.")
 
     # Add images to the url entry
     # Note: Google Sitemap limit is 1000 images per URL. 
     # If we exceed this, we'd need to paginate URLs.
+    # Bind loop-invariant globals/attributes to locals once.
+    append = out.append
+    _encode = encode_url_path
+    _escape = escape
+    _Path = Path
+    # encode_url_path output only contains URL-safe characters, so only the
+    # base URL needs XML escaping, and only once.
+    loc_open = f"      <image:loc>{escape(BASE_URL)}"
     count = 0
     for img in images:
         if count >= 1000:
             print("Warning: Reached 1000 image limit per URL. Truncating.")
             break
-            
-        image_element = ET.SubElement(url_element, "image:image")
-        
-        image_loc = ET.SubElement(image_element, "image:loc")
+
+        append("    <image:image>\n")
         # Ensure the URL is absolute and properly URL-encoded
-        encoded_path = encode_url_path(img['monkey_url'])
-        image_loc.text = f"{BASE_URL}{encoded_path}"
-        
+        encoded_path = _encode(img['monkey_url'])
+        append(f"{loc_open}{encoded_path}</image:loc>\n")
+
         # Optional: Title (using original name or id)
         if 'original_name' in img:
-            image_title = ET.SubElement(image_element, "image:title")
-            image_title.text = Path(img['original_name']).stem
+            append(f"      <image:title>{_escape(_Path(img['original_name']).stem)}</image:title>\n")
+        append("    </image:image>\n")
 
         count += 1
 
+    out.append("  </url>\n</urlset>\n")
+
     # Write to file
-    with open(OUTPUT_FILE, "w", encoding="utf-8") as f:
-        f.write(prettify(urlset))
+    OUTPUT_FILE.write_bytes("".join(out).encode("utf-8"))
 
     print(f"Sitemap generated successfully at {OUTPUT_FILE}")
     print(f"Total images included: {count}")
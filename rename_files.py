@@ -1,25 +1,37 @@
 import os
-from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+PIG = "猪"
+MONKEY = "猴"
+
+def _rename(directory, name):
+    new_name = name.replace(PIG, MONKEY)
+    try:
+        os.rename(os.path.join(directory, name), os.path.join(directory, new_name))
+        return f"Renamed: {name} -> {new_name}", True
+    except Exception as e:
+        return f"Error renaming {name}: {e}", False
 
 def rename_files(directory):
-    path = Path(directory)
-    if not path.exists():
+    # scandir's DirEntry avoids a Path object per file, and is_file() answers
+    # from the readdir d_type; the renames are independent syscalls, so overlap
+    # them on slow (network/USB) storage.
+    try:
+        with os.scandir(directory) as it:
+            names = [e.name for e in it if PIG in e.name and e.is_file(follow_symlinks=False)]
+    except FileNotFoundError:
         print(f"Directory {directory} does not exist.")
         return
 
     print(f"Renaming files in {directory}...")
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        results = list(executor.map(partial(_rename, directory), names))
+
     count = 0
-    for file in path.iterdir():
-        if file.is_file():
-            if "猪" in file.name:
-                new_name = file.name.replace("猪", "猴")
-                new_path = path / new_name
-                try:
-                    file.rename(new_path)
-                    print(f"Renamed: {file.name} -> {new_name}")
-                    count += 1
-                except Exception as e:
-                    print(f"Error renaming {file.name}: {e}")
+    for message, ok in results:
+        print(message)
+        count += ok
     print(f"Renamed {count} files in {directory}.")
 
 if __name__ == "__main__":